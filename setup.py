@@ -30,6 +30,7 @@ setup(
     url="https://github.com/anoadragon453/nio-template",
     description="A matrix bot to do amazing things!",
     packages=find_packages(exclude=["tests", "tests.*"]),
+    python_requires=">=3.7",
     install_requires=[
         "matrix-nio[e2e]>=0.10.0",
         "Markdown>=3.1.1",
@@ -37,6 +38,7 @@ setup(
     ],
     extras_require={
         "postgres": ["psycopg2>=2.8.5"],
+        "uvloop": ["uvloop>=0.14.0"],
         "dev": [
             "isort==5.0.4",
             "flake8==3.8.3",
@@ -47,8 +49,6 @@ setup(
     classifiers=[
         "License :: OSI Approved :: Apache Software License",
         "Programming Language :: Python :: 3 :: Only",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
     ],
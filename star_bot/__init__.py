@@ -1,8 +1,8 @@
 import sys
 
 # Check that we're not running on an unsupported Python version.
-if sys.version_info < (3, 5):
-    print("star_bot requires Python 3.5 or above.")
+if sys.version_info < (3, 7):
+    print("star_bot requires Python 3.7 or above.")
     sys.exit(1)
 
 __version__ = "0.0.1"
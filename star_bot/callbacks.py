@@ -1,13 +1,21 @@
+import asyncio
 import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
 
 from nio import (
     AsyncClient,
+    Event,
     InviteMemberEvent,
     JoinError,
     MatrixRoom,
     MegolmEvent,
+    RedactionEvent,
     RoomGetEventError,
+    RoomMemberEvent,
     RoomMessageText,
+    RoomSendError,
     RoomSendResponse,
     LocalProtocolError,
     UnknownEvent,
@@ -21,6 +29,24 @@ from star_bot.storage import Storage
 
 logger = logging.getLogger(__name__)
 
+# The reaction that stars a message
+_STAR_EMOJI = "\N{WHITE MEDIUM STAR}\uFE0F"
+
+# The maximum number of fetched events to keep around. The same message is often starred
+# more than once, so this saves re-fetching it from the homeserver each time
+_EVENT_CACHE_SIZE = 512
+
+# How long to wait, in seconds, for further stars before posting to the star room. Stars
+# that arrive within this window are posted together as a single message
+_STAR_BATCH_DELAY = 0.5
+
+# How long, in seconds, to ignore further stars of an event after starring it. Clients
+# can send two reactions in quick succession when double-tapped
+_STAR_DEDUP_WINDOW = 5.0
+
+# How many times to try posting to the star room before giving up
+_STAR_SEND_ATTEMPTS = 4
+
 
 class Callbacks:
     def __init__(self, client: AsyncClient, store: Storage, config: Config):
@@ -37,8 +63,82 @@ class Callbacks:
         self.config = config
         self.command_prefix = config.command_prefix
 
+        # Our own user ID. The client only learns this on login, after we're created
+        self._own_user_id = config.user_id
+        self._star_room_id = config.star_room_id
+
+        # Whether we're joined to the star room. Seeded at startup by
+        # `set_in_star_room`, then kept up to date by `member` so that reactions don't
+        # need to consult the client's room list
+        self._in_star_room: bool = False
+
+        # Events we've previously fetched, keyed by (room ID, event ID), in
+        # least-recently-used order
+        self._event_cache: "OrderedDict[Tuple[str, str], Event]" = OrderedDict()
+
+        # Star room messages waiting to be sent. A single worker task sends them all,
+        # so that sends and their retries don't pile up
+        self._send_queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._send_worker: Optional[asyncio.Task] = None
+
+        # Reactions being handled in the background. asyncio only keeps weak references
+        # to tasks, so hold on to them here until they're done
+        self._bg_tasks: Set[asyncio.Task] = set()
+
+        # IDs of events currently being starred, mapped to when we'll next accept a
+        # star for them
+        self._inflight: Dict[str, float] = {}
+
+    def set_in_star_room(self, joined: bool) -> None:
+        """Record whether we're joined to the star room.
+
+        Membership we already had when the bot started only arrives as room state,
+        which matrix-nio doesn't pass to event callbacks, so `member` never sees it.
+
+        Args:
+            joined: Whether we're joined to the star room.
+        """
+        self._in_star_room = joined
+
+    async def _get_event_cached(self, room_id: str, event_id: str) -> Optional[Event]:
+        """Fetch an event, using a previously fetched copy if we have one.
+
+        Args:
+            room_id: The ID of the room the event was sent in.
+
+            event_id: The ID of the event to fetch.
+
+        Returns:
+            The event, or None if it could not be fetched.
+        """
+        key = (room_id, event_id)
+        event = self._event_cache.get(key)
+        if event is not None:
+            self._event_cache.move_to_end(key)
+            return event
+
+        event_response = await self.client.room_get_event(room_id, event_id)
+        if isinstance(event_response, RoomGetEventError):
+            logger.warning(
+                "Error getting event %s: %s", event_id, event_response.message
+            )
+            return None
+
+        # Only cache successfully fetched and decrypted events, so that errors (and
+        # events we don't have the keys for yet) are retried next time
+        if not isinstance(event_response.event, MegolmEvent):
+            self._event_cache[key] = event_response.event
+            if len(self._event_cache) > _EVENT_CACHE_SIZE:
+                self._event_cache.popitem(last=False)
+
+        return event_response.event
+
     async def _reaction(
-        self, room: MatrixRoom, event: UnknownEvent, reacted_to_id: str
+        self,
+        room: MatrixRoom,
+        event: Event,
+        reacted_to_id: str,
+        reaction_key: Optional[str],
     ) -> None:
         """A reaction was sent to one of our messages. Let's send a reply acknowledging it.
 
@@ -48,83 +148,237 @@ class Callbacks:
             event: The reaction event.
 
             reacted_to_id: The event ID that the reaction points to.
+
+            reaction_key: The content of the reaction, e.g. an emoji.
         """
 
         if isinstance(event, MegolmEvent):
             logger.debug("The event wasn't decrypted for some raisin")
             return
 
-        logger.debug(f"Got reaction to {room.room_id} from {event.sender}.")
-
-        # Get the original event that was reacted to
-        event_response = await self.client.room_get_event(room.room_id, reacted_to_id)
-        if isinstance(event_response, RoomGetEventError):
-            logger.warning(
-                "Error getting event that was reacted to (%s)", reacted_to_id
-            )
-            return
-        reacted_to_event = event_response.event
-        if isinstance(reacted_to_event, MegolmEvent):
-            logger.debug("The reacted to event wasn't decrypted for some raisin")
-            return
+        logger.debug("Got reaction to %s from %s.", room.room_id, event.sender)
 
+        # Filter out reactions we don't care about before making any requests.
         # Ignore other users' reactions
-        if event.sender != self.client.user:
+        if event.sender != self._own_user_id:
             return
 
         # Don't react to my reactions in the star room
-        if room.room_id == self.config.star_room_id:
+        if room.room_id == self._star_room_id:
             return
 
-        reaction_content = (
-            event.source.get("content", {}).get("m.relates_to", {}).get("key")
-        )
+        if reaction_key != _STAR_EMOJI:
+            return
 
-        if reaction_content != '⭐️':
+        # Ignore stars of events we're already starring
+        now = time.monotonic()
+        if self._inflight.get(reacted_to_id, 0) > now:
+            logger.debug("Ignoring duplicate star of %s", reacted_to_id)
             return
+        self._inflight = {
+            event_id: expiry
+            for event_id, expiry in self._inflight.items()
+            if expiry > now
+        }
+        self._inflight[reacted_to_id] = now + _STAR_DEDUP_WINDOW
+
+        queued = False
+        try:
+            queued = await self._queue_star(room, reacted_to_id)
+        finally:
+            # Allow the event to be starred again if this attempt didn't work out
+            if not queued:
+                self._inflight.pop(reacted_to_id, None)
+
+    async def _queue_star(self, room: MatrixRoom, reacted_to_id: str) -> bool:
+        """Queue up a starred event to be posted to the star room.
+
+        Args:
+            room: The room the starred event was sent in.
+
+            reacted_to_id: The ID of the starred event.
+
+        Returns:
+            Whether the event was queued.
+        """
+        if not self._in_star_room:
+            # The sync loop may have picked up our join without us having seen the
+            # membership event yet
+            self._in_star_room = self._star_room_id in self.client.rooms
+            if not self._in_star_room:
+                logger.info("We weren't in the star room, bailing")
+                return False
+
+        # Get the original event that was reacted to
+        reacted_to_event = await self._get_event_cached(room.room_id, reacted_to_id)
+        if reacted_to_event is None:
+            return False
+        if isinstance(reacted_to_event, MegolmEvent):
+            logger.debug("The reacted to event wasn't decrypted for some raisin")
+            return False
 
         pill = make_pill(reacted_to_event.sender)
+        self._send_queue.put_nowait(
+            self.config.star_message_template.format_map(
+                {
+                    "room_id": room.room_id,
+                    "room_name": room.display_name,
+                    "pill": pill,
+                    "body": reacted_to_event.body,
+                    "event_id": reacted_to_event.event_id,
+                    "via": self.config.star_via,
+                }
+            )
+        )
+        if self._send_worker is None or self._send_worker.done():
+            self._send_worker = asyncio.create_task(self._star_send_worker())
+
+        return True
+
+    async def _star_send_worker(self) -> None:
+        """Post queued stars to the star room, one message at a time. Stars that arrive
+        shortly after one another are posted together as a single message.
+        """
         while True:
-            logger.info("Are we in the room?")
-            logger.info(self.config.star_room_id in self.client.rooms)
-            if self.config.star_room_id not in self.client.rooms:
-                logger.info("We weren't in the room, bailing")
-                break
-            logger.info(self.client.rooms[self.config.star_room_id])
+            messages = [await self._send_queue.get()]
+
+            # Wait for any further stars to arrive, then take everything queued
+            await asyncio.sleep(_STAR_BATCH_DELAY)
+            while not self._send_queue.empty():
+                messages.append(self._send_queue.get_nowait())
+
+            try:
+                await self._send_to_star_room(messages)
+            except Exception:
+                # Keep the worker alive, otherwise no more stars would be posted
+                logger.exception("Error posting %d stars to star room", len(messages))
+            finally:
+                for _ in messages:
+                    self._send_queue.task_done()
+
+    async def _send_to_star_room(self, messages: List[str]) -> None:
+        """Post messages to the star room as a single message, retrying on failure.
+
+        Args:
+            messages: The messages to post.
+        """
+        for attempt in range(_STAR_SEND_ATTEMPTS):
+            logger.debug("star_room joined=%s", self._in_star_room)
+            if not self._in_star_room:
+                logger.info("We weren't in the star room, bailing")
+                return
             try:
                 result = await send_text_to_room(
                     self.client,
-                    self.config.star_room_id,
-                    f"<a href=\"https://matrix.to/#/{room.room_id}\">{room.display_name}</a>—{pill}: {reacted_to_event.body} [->](https://matrix.to/#/{room.room_id}/{reacted_to_event.event_id}?via=lant.uk)",
+                    self._star_room_id,
+                    "\n\n".join(messages),
                     notice=False
                 )
-                logger.info(result)
+                if isinstance(result, RoomSendError):
+                    logger.error(
+                        "Error posting %d stars to star room: %s",
+                        len(messages),
+                        result.message,
+                    )
+                else:
+                    logger.debug(
+                        "Sent %d stars to star room: %s", len(messages), result
+                    )
                 return
             except LocalProtocolError as e:
                 logger.error(e)
-                await self.client.sync()
+                if attempt == _STAR_SEND_ATTEMPTS - 1:
+                    break
+                # Back off and let the sync loop bring our state up to date before
+                # trying again
+                await asyncio.sleep(0.5 * 2 ** attempt)
 
+        logger.error(
+            "Giving up posting %d stars to the star room after %d attempts",
+            len(messages),
+            _STAR_SEND_ATTEMPTS,
+        )
 
-    async def unknown(self, room: MatrixRoom, event: UnknownEvent) -> None:
-        """Callback for when an event with a type that is unknown to matrix-nio is received.
-        Currently this is used for reaction events, which are not yet part of a released
-        matrix spec (and are thus unknown to nio).
+    async def member(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
+        """Callback for when a room membership event is received. Used to track whether
+        we're joined to the star room.
+
+        Args:
+            room: The room the membership event was sent in.
+
+            event: The membership event.
+        """
+        if room.room_id != self._star_room_id:
+            return
+        if event.state_key != self._own_user_id:
+            return
+
+        self._in_star_room = event.membership == "join"
+        logger.debug("Star room membership changed to %s", event.membership)
+
+    async def redaction(self, room: MatrixRoom, event: RedactionEvent) -> None:
+        """Callback for when an event is redacted. Drops any cached copy of the event.
+
+        Args:
+            room: The room the redaction was sent in.
+
+            event: The redaction event.
+        """
+        self._event_cache.pop((room.room_id, event.redacts), None)
+
+    def on_reaction(self, room: MatrixRoom, event: Event) -> None:
+        """Callback for when a reaction event is received.
+
+        Newer versions of matrix-nio parse reactions into ReactionEvents. Older versions
+        don't know about them and hand them to us as UnknownEvents, in which case this
+        callback will see every unknown event. It's synchronous so that filtering out
+        those other events doesn't cost a coroutine each; any actual work is handed off
+        to a task.
 
         Args:
             room: The room the reaction was sent in.
 
-            event: The event itself.
+            event: The reaction event.
         """
-        if event.type == "m.reaction":
-            # Get the ID of the event this was a reaction to
-            relation_dict = event.source.get("content", {}).get("m.relates_to", {})
+        if event.source.get("type") != "m.reaction":
+            return
 
-            reacted_to = relation_dict.get("event_id")
-            if reacted_to and relation_dict.get("rel_type") == "m.annotation":
-                await self._reaction(room, event, reacted_to)
-                return
+        # Get the ID of the event this was a reaction to
+        relation_dict = event.source.get("content", {}).get("m.relates_to")
+        if not relation_dict:
+            return
+
+        reacted_to = relation_dict.get("event_id")
+        if reacted_to and relation_dict.get("rel_type") == "m.annotation":
+            # Handle the reaction in the background so that we don't hold up the sync
+            # loop while we talk to the homeserver
+            task = asyncio.create_task(
+                self._reaction(room, event, reacted_to, relation_dict.get("key"))
+            )
+            self._bg_tasks.add(task)
+            task.add_done_callback(self._bg_task_done)
+
+    def _bg_task_done(self, task: asyncio.Task) -> None:
+        """Forget about a finished background task, logging any error it raised.
+
+        Args:
+            task: The finished task.
+        """
+        self._bg_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error handling reaction", exc_info=task.exception())
+
+    def unknown(self, room: MatrixRoom, event: UnknownEvent) -> None:
+        """Callback for when an event with a type that is unknown to matrix-nio is received.
 
+        Args:
+            room: The room the event was sent in.
 
+            event: The event itself.
+        """
         logger.debug(
-            f"Got unknown event with type to {event.type} from {event.sender} in {room.room_id}."
+            "Got unknown event with type to %s from %s in %s.",
+            event.type,
+            event.sender,
+            room.room_id,
         )
@@ -67,7 +67,7 @@ async def send_text_to_room(
             ignore_unverified_devices=True,
         )
     except SendRetryError:
-        logger.exception(f"Unable to send message response to {room_id}")
+        logger.exception("Unable to send message response to %s", room_id)
 
 
 def make_pill(user_id: str, displayname: str = None) -> str:
@@ -132,13 +132,15 @@ async def react_to_event(
 async def decryption_failure(self, room: MatrixRoom, event: MegolmEvent) -> None:
     """Callback for when an event fails to decrypt. Inform the user"""
     logger.error(
-        f"Failed to decrypt event '{event.event_id}' in room '{room.room_id}'!"
-        f"\n\n"
-        f"Tip: try using a different device ID in your config file and restart."
-        f"\n\n"
-        f"If all else fails, delete your store directory and let the bot recreate "
-        f"it (your reminders will NOT be deleted, but the bot may respond to existing "
-        f"commands a second time)."
+        "Failed to decrypt event '%s' in room '%s'!"
+        "\n\n"
+        "Tip: try using a different device ID in your config file and restart."
+        "\n\n"
+        "If all else fails, delete your store directory and let the bot recreate "
+        "it (your reminders will NOT be deleted, but the bot may respond to existing "
+        "commands a second time).",
+        event.event_id,
+        room.room_id,
     )
 
     user_msg = (
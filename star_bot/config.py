@@ -107,6 +107,29 @@ class Config:
 
         self.star_room_id = self._get_cfg(["starbot", "room_id"], required=True)
 
+        # The server to route matrix.to links through. Defaults to the bot's own server
+        self.star_via = self._get_cfg(
+            ["starbot", "via"], default=self.user_id.split(":", 1)[1]
+        )
+
+        # The message posted to the star room for each starred event
+        self.star_message_template = self._get_cfg(
+            ["starbot", "message_template"],
+            default=(
+                '<a href="https://matrix.to/#/{room_id}">{room_name}</a>—{pill}: {body} '
+                "[->](https://matrix.to/#/{room_id}/{event_id}?via={via})"
+            ),
+        )
+
+        # Check the template only uses the fields we fill in
+        template_fields = ("room_id", "room_name", "pill", "body", "event_id", "via")
+        try:
+            self.star_message_template.format_map(
+                {field: "" for field in template_fields}
+            )
+        except (KeyError, ValueError) as e:
+            raise ConfigError(f"Invalid starbot.message_template: {e!r}")
+
     def _get_cfg(
         self,
         path: List[str],
@@ -2,7 +2,6 @@
 import asyncio
 import logging
 import sys
-from time import sleep
 
 from aiohttp import ClientConnectionError, ServerDisconnectedError
 from nio import (
@@ -14,10 +13,18 @@ from nio import (
     MegolmEvent,
     RoomMessageText,
     RedactionEvent,
+    RoomMemberEvent,
     JoinError,
     UnknownEvent,
 )
 
+try:
+    from nio import ReactionEvent
+except ImportError:
+    # Older versions of matrix-nio don't know about reactions, and hand them to us as
+    # UnknownEvents instead
+    ReactionEvent = UnknownEvent
+
 from star_bot.chat_functions import send_text_to_room
 from star_bot.callbacks import Callbacks
 from star_bot.config import Config
@@ -26,6 +33,40 @@ from star_bot.storage import Storage
 logger = logging.getLogger(__name__)
 
 
+async def _join_with_retry(
+    client: AsyncClient, room_id: str, attempts: int = 3
+) -> bool:
+    """Join a room, retrying with exponential backoff on failure.
+
+    Args:
+        client: The client to communicate to matrix with.
+
+        room_id: The ID or alias of the room to join.
+
+        attempts: How many times to try joining before giving up.
+
+    Returns:
+        Whether the room was joined successfully.
+    """
+    logger.info("Joining room %s", room_id)
+    for attempt in range(attempts):
+        result = await client.join(room_id)
+        if not isinstance(result, JoinError):
+            logger.info("Joined room %s", room_id)
+            return True
+
+        logger.error(
+            "Error joining room %s (attempt %d): %s",
+            room_id,
+            attempt,
+            result.message,
+        )
+        if attempt < attempts - 1:
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    return False
+
+
 async def main():
     """The first function that is run when starting the bot"""
 
@@ -65,84 +106,88 @@ async def main():
 
     # Set up event callbacks
     callbacks = Callbacks(client, store, config)
+    client.add_event_callback(callbacks.on_reaction, (ReactionEvent,))
     client.add_event_callback(callbacks.unknown, (UnknownEvent,))
-
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            if config.user_token:
-                # Use token to log in
-                client.load_store()
-
-                # Sync encryption keys with the server
-                if client.should_upload_keys:
-                    await client.keys_upload()
-            else:
-                # Try to login with the configured username/password
-                try:
-                    login_response = await client.login(
-                        password=config.user_password,
-                        device_name=config.device_name,
-                    )
-
-                    # Check if login failed
-                    if type(login_response) == LoginError:
-                        logger.error("Failed to login: %s", login_response.message)
-                        return False
-                except LocalProtocolError as e:
-                    # There's an edge case here where the user hasn't installed the correct C
-                    # dependencies. In that case, a LocalProtocolError is raised on login.
-                    logger.fatal(
-                        "Failed to login. Have you installed the correct dependencies? "
-                        "https://github.com/poljar/matrix-nio#installation "
-                        "Error: %s",
-                        e,
-                    )
-                    return False
-
-                # Login succeeded!
-
-            logger.info(f"Logged in as {config.user_id}")
-
-            # Try and get the full state so we knoow what rooms we're in
-            # EDIT: This doesn't seem to help
-            # await client.sync(full_state=True)
-
-            logger.info("Joining star room")
-            if config.star_room_id not in client.rooms:
-                for attempt in range(3):
-                    logger.info(f"attempt {attempt}")
-                    result = await client.join(config.star_room_id)
-                    if type(result) == JoinError:
-                        logger.error(
-                            f"Error joining room {room.room_id} (attempt %d): %s",
-                            attempt,
-                            result.message,
+    client.add_event_callback(callbacks.member, (RoomMemberEvent,))
+    client.add_event_callback(callbacks.redaction, (RedactionEvent,))
+
+    # Keep trying to reconnect on failure (with some time in-between). The client, and
+    # its pool of connections to the homeserver, is reused across reconnects
+    try:
+        while True:
+            try:
+                if config.user_token:
+                    # Use token to log in
+                    client.load_store()
+
+                    # Sync encryption keys with the server
+                    if client.should_upload_keys:
+                        await client.keys_upload()
+                else:
+                    # Try to login with the configured username/password
+                    try:
+                        login_response = await client.login(
+                            password=config.user_password,
+                            device_name=config.device_name,
                         )
-                    else:
-                        logger.info(result)
-                        logger.info("We're in the room (aside: we're not)")
-            else:
-                logger.info("We're already joined")
 
-            # await send_text_to_room(
-            #     client,
-            #     config.star_room_id,
-            #     'STARBOT ONLINE',
-            #     notice=True
-            # )
-
-            await client.sync_forever(timeout=9000000, full_state=True)
+                        # Check if login failed
+                        if type(login_response) == LoginError:
+                            logger.error("Failed to login: %s", login_response.message)
+                            return False
+                    except LocalProtocolError as e:
+                        # There's an edge case here where the user hasn't installed the
+                        # correct C dependencies. In that case, a LocalProtocolError is
+                        # raised on login.
+                        logger.fatal(
+                            "Failed to login. "
+                            "Have you installed the correct dependencies? "
+                            "https://github.com/poljar/matrix-nio#installation "
+                            "Error: %s",
+                            e,
+                        )
+                        return False
 
-        except (ClientConnectionError, ServerDisconnectedError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
+                    # Login succeeded!
 
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
+                logger.info("Logged in as %s", config.user_id)
 
+                # Get the full state once up front so we know what rooms we're in
+                await client.sync(full_state=True, timeout=30000)
 
-# Run the main function in an asyncio event loop
-asyncio.get_event_loop().run_until_complete(main())
+                # Join any rooms we aren't already in, all at once
+                rooms = [config.star_room_id]
+                await asyncio.gather(
+                    *(
+                        _join_with_retry(client, room_id)
+                        for room_id in rooms
+                        if room_id not in client.rooms
+                    )
+                )
+
+                # Membership we already had doesn't reach the event callbacks, so tell
+                # them where we stand. Rooms we've just joined will be picked up when
+                # the join comes down the next sync
+                callbacks.set_in_star_room(config.star_room_id in client.rooms)
+
+                # await send_text_to_room(
+                #     client,
+                #     config.star_room_id,
+                #     'STARBOT ONLINE',
+                #     notice=True
+                # )
+
+                # Long-poll for up to 30s at a time. Asking for the full state would
+                # make the server respond immediately, even when nothing has happened
+                await client.sync_forever(
+                    timeout=30000, full_state=False, loop_sleep_time=2000
+                )
+
+            except (ClientConnectionError, ServerDisconnectedError):
+                logger.warning("Unable to connect to homeserver, retrying in 15s...")
+
+                # Sleep so we don't bombard the server with login requests
+                await asyncio.sleep(15)
+    finally:
+        # Make sure to close the client connection once we're done for good
+        await client.close()
@@ -44,7 +44,7 @@ class Storage:
             if migration_level < latest_migration_version:
                 self._run_migrations(migration_level)
 
-        logger.info(f"Database initialization of type '{self.db_type}' complete")
+        logger.info("Database initialization of type '%s' complete", self.db_type)
 
     def _get_database_connection(
         self, database_type: str, connection_string: str
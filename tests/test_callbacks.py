@@ -1,9 +1,10 @@
+import asyncio
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import nio
 
-from star_bot.callbacks import Callbacks
+from star_bot.callbacks import _STAR_SEND_ATTEMPTS, Callbacks
 from star_bot.storage import Storage
 
 from tests.utils import make_awaitable, run_coroutine
@@ -11,6 +12,9 @@ from tests.utils import make_awaitable, run_coroutine
 
 class CallbacksTestCase(unittest.TestCase):
     def setUp(self) -> None:
+        # run_coroutine closes the event loop after use, so give each test a fresh one
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
         # Create a Callbacks object and give it some Mock'd objects to use
         self.fake_client = Mock(spec=nio.AsyncClient)
         self.fake_client.user = "@fake_user:example.com"
@@ -19,11 +23,64 @@ class CallbacksTestCase(unittest.TestCase):
 
         # We don't spec config, as it doesn't currently have well defined attributes
         self.fake_config = Mock()
+        self.fake_config.user_id = "@fake_user:example.com"
+        self.fake_config.star_room_id = "!star:example.com"
+        self.fake_config.star_via = "example.com"
+        self.fake_config.star_message_template = "{room_name}—{pill}: {body}"
 
         self.callbacks = Callbacks(
             self.fake_client, self.fake_storage, self.fake_config
         )
 
+        # Fake fetching and sending events, recording what was fetched and sent
+        self.fetched = []
+        self.sent_messages = []
+        # Event IDs whose next fetch should fail, or that can't be decrypted
+        self.failing_fetches = set()
+        self.undecryptable_events = set()
+        self.fake_client.room_get_event = self._fake_room_get_event
+        self.fake_client.room_send = self._fake_room_send
+
+        self.fake_room = Mock(spec=nio.MatrixRoom)
+        self.fake_room.room_id = "!abcdefg:example.com"
+        self.fake_room.display_name = "Some room"
+
+    async def _fake_room_get_event(self, room_id, event_id):
+        """Stands in for AsyncClient.room_get_event"""
+        self.fetched.append(event_id)
+        if event_id in self.failing_fetches:
+            self.failing_fetches.remove(event_id)
+            return nio.RoomGetEventError("Something went wrong")
+
+        if event_id in self.undecryptable_events:
+            fake_event = Mock(spec=nio.MegolmEvent)
+        else:
+            fake_event = Mock(spec=nio.RoomMessageText)
+            fake_event.body = f"Message {event_id}"
+        fake_event.sender = "@some_other_fake_user:example.com"
+        fake_event.event_id = event_id
+        return Mock(spec=nio.RoomGetEventResponse, event=fake_event)
+
+    async def _fake_room_send(self, room_id, message_type, content, **kwargs):
+        """Stands in for AsyncClient.room_send"""
+        self.sent_messages.append((room_id, content["body"]))
+
+    def _make_reaction(self, event_id, sender="@fake_user:example.com"):
+        """Create a star reaction to the given event"""
+        fake_reaction_event = Mock(spec=nio.UnknownEvent)
+        fake_reaction_event.sender = sender
+        fake_reaction_event.source = {
+            "type": "m.reaction",
+            "content": {
+                "m.relates_to": {
+                    "rel_type": "m.annotation",
+                    "event_id": event_id,
+                    "key": "⭐️",
+                }
+            },
+        }
+        return fake_reaction_event
+
     def test_invite(self):
         """Tests the callback for InviteMemberEvents"""
         # Tests that the bot attempts to join a room after being invited to it
@@ -45,6 +102,177 @@ class CallbacksTestCase(unittest.TestCase):
         # Check that we attempted to join the room
         self.fake_client.join.assert_called_once_with(fake_room_id)
 
+    def test_member_tracks_star_room(self):
+        """Tests that the 'member' callback tracks our membership of the star room"""
+        fake_star_room = Mock(spec=nio.MatrixRoom)
+        fake_star_room.room_id = "!star:example.com"
+
+        fake_member_event = Mock(spec=nio.RoomMemberEvent)
+        fake_member_event.state_key = "@fake_user:example.com"
+        fake_member_event.membership = "join"
+
+        async def member_changes():
+            await self.callbacks.member(fake_star_room, fake_member_event)
+            self.assertTrue(self.callbacks._in_star_room)
+
+            # Other users' membership changes shouldn't affect us
+            fake_member_event.state_key = "@some_other_fake_user:example.com"
+            fake_member_event.membership = "leave"
+            await self.callbacks.member(fake_star_room, fake_member_event)
+            self.assertTrue(self.callbacks._in_star_room)
+
+            fake_member_event.state_key = "@fake_user:example.com"
+            await self.callbacks.member(fake_star_room, fake_member_event)
+            self.assertFalse(self.callbacks._in_star_room)
+
+        run_coroutine(member_changes())
+
+    def test_reaction_ignores_other_users_without_fetching(self):
+        """Tests that other users' reactions are dropped before fetching the event"""
+        fake_reaction_event = self._make_reaction(
+            "$someevent", sender="@some_other_fake_user:example.com"
+        )
+
+        async def react():
+            self.callbacks.on_reaction(self.fake_room, fake_reaction_event)
+            await asyncio.gather(*self.callbacks._bg_tasks)
+
+        run_coroutine(react())
+
+        self.assertEqual(self.fetched, [])
+
+    @patch("star_bot.callbacks._EVENT_CACHE_SIZE", 2)
+    def test_event_cache(self):
+        """Tests that fetched events are cached, evicted and invalidated on redaction"""
+        self.undecryptable_events.add("$encrypted")
+
+        fake_redaction_event = Mock(spec=nio.RedactionEvent)
+        fake_redaction_event.redacts = "$first"
+
+        async def fetch(*event_ids):
+            for event_id in event_ids:
+                await self.callbacks._get_event_cached(
+                    self.fake_room.room_id, event_id
+                )
+
+        async def fetch_events():
+            # Repeated fetches are served from the cache
+            await fetch("$first", "$first")
+            self.assertEqual(self.fetched, ["$first"])
+
+            # Redacting an event drops it from the cache
+            await self.callbacks.redaction(self.fake_room, fake_redaction_event)
+            await fetch("$first")
+            self.assertEqual(self.fetched, ["$first", "$first"])
+
+            # The least recently used event is evicted once the cache is full
+            await fetch("$second", "$first", "$third", "$first", "$second")
+            self.assertEqual(
+                self.fetched, ["$first", "$first", "$second", "$third", "$second"]
+            )
+
+            # Events that couldn't be decrypted aren't cached
+            await fetch("$encrypted", "$encrypted")
+            self.assertEqual(self.fetched[-2:], ["$encrypted", "$encrypted"])
+
+        run_coroutine(fetch_events())
+
+    @patch("star_bot.callbacks._STAR_BATCH_DELAY", 0)
+    def test_reactions_are_batched(self):
+        """Tests that stars arriving close together are posted as a single message"""
+        self.callbacks.set_in_star_room(True)
+
+        async def star_twice():
+            self.callbacks.on_reaction(self.fake_room, self._make_reaction("$first"))
+            self.callbacks.on_reaction(self.fake_room, self._make_reaction("$second"))
+            # Wait for the reactions to be handled and the batch to be sent
+            await asyncio.gather(*self.callbacks._bg_tasks)
+            await self.callbacks._send_queue.join()
+            self.callbacks._send_worker.cancel()
+
+        run_coroutine(star_twice())
+
+        self.assertEqual(len(self.sent_messages), 1)
+        room_id, body = self.sent_messages[0]
+        self.assertEqual(room_id, "!star:example.com")
+        self.assertIn("Message $first", body)
+        self.assertIn("Message $second", body)
+
+    @patch("star_bot.callbacks._STAR_BATCH_DELAY", 0)
+    def test_duplicate_stars_are_dropped(self):
+        """Tests that repeat stars of an event are dropped, unless starring it failed"""
+        self.callbacks.set_in_star_room(True)
+        self.failing_fetches.add("$flaky")
+
+        async def star(event_id):
+            await self.callbacks._reaction(
+                self.fake_room, self._make_reaction(event_id), event_id, "⭐️"
+            )
+
+        async def star_events():
+            await star("$first")
+            await star("$first")
+            await star("$flaky")
+            await star("$flaky")
+            await self.callbacks._send_queue.join()
+            self.callbacks._send_worker.cancel()
+
+        run_coroutine(star_events())
+
+        self.assertEqual(self.fetched, ["$first", "$flaky", "$flaky"])
+        self.assertEqual(len(self.sent_messages), 1)
+        _, body = self.sent_messages[0]
+        self.assertEqual(body.count("Message $first"), 1)
+        self.assertIn("Message $flaky", body)
+
+    @patch("star_bot.callbacks._STAR_BATCH_DELAY", 0)
+    def test_star_room_send_retries_are_bounded(self):
+        """Tests that sends are retried with backoff, then given up on"""
+        self.callbacks.set_in_star_room(True)
+
+        send_attempts = []
+
+        async def fake_room_send(room_id, message_type, content, **kwargs):
+            send_attempts.append(content["body"])
+            # Sending the first star always fails
+            if "Message $first" in content["body"]:
+                raise nio.LocalProtocolError("Something went wrong")
+
+        self.fake_client.room_send = fake_room_send
+
+        sleeps = []
+        real_sleep = asyncio.sleep
+
+        async def fake_sleep(delay):
+            sleeps.append(delay)
+            await real_sleep(0)
+
+        async def star(event_id):
+            await self.callbacks._reaction(
+                self.fake_room, self._make_reaction(event_id), event_id, "⭐️"
+            )
+            await self.callbacks._send_queue.join()
+
+        async def star_events():
+            await star("$first")
+            await star("$second")
+            self.callbacks._send_worker.cancel()
+
+        with patch("star_bot.callbacks.asyncio.sleep", fake_sleep):
+            run_coroutine(star_events())
+
+        # The first star was tried the maximum number of times, then the worker moved
+        # on to the second
+        self.assertEqual(len(send_attempts), _STAR_SEND_ATTEMPTS + 1)
+        self.assertTrue(
+            all("Message $first" in body for body in send_attempts[:-1])
+        )
+        self.assertIn("Message $second", send_attempts[-1])
+
+        # Backing off between attempts, but not after the last one. The zero delays
+        # are the (patched) batching window before each send
+        self.assertEqual(sleeps, [0, 0.5, 1, 2, 0])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,79 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import Mock
 
+import yaml
+
 from star_bot.config import Config
 from star_bot.errors import ConfigError
 
 
 class ConfigTestCase(unittest.TestCase):
+    def _make_config(self, starbot_options: dict) -> Config:
+        """Create a Config from a minimal config file with the given starbot options"""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+
+        config_dict = {
+            "matrix": {
+                "user_id": "@bot:example.com",
+                "user_password": "password",
+                "homeserver_url": "https://example.com",
+                "device_id": "ABCDEFGHIJ",
+            },
+            "storage": {
+                "database": "sqlite://bot.db",
+                "store_path": os.path.join(tmp_dir.name, "store"),
+            },
+            "logging": {
+                "file_logging": {"enabled": False},
+                "console_logging": {"enabled": False},
+            },
+            "starbot": {"room_id": "!star:example.com", **starbot_options},
+        }
+        config_path = os.path.join(tmp_dir.name, "config.yaml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump(config_dict, f)
+
+        return Config(config_path)
+
+    def test_star_message_options(self):
+        """Test the defaults and validation of the star room message options"""
+        # The via server defaults to the bot's own server
+        config = self._make_config({})
+        self.assertEqual(config.star_via, "example.com")
+
+        # The default template fills in every field
+        message = config.star_message_template.format_map(
+            {
+                "room_id": "!room:example.com",
+                "room_name": "Some room",
+                "pill": "@user:example.com",
+                "body": "Hello",
+                "event_id": "$event",
+                "via": config.star_via,
+            }
+        )
+        self.assertIn("Some room", message)
+        self.assertIn("Hello", message)
+        self.assertIn("!room:example.com/$event?via=example.com", message)
+
+        # Both can be overridden
+        config = self._make_config(
+            {"via": "other.example.com", "message_template": "{pill}: {body}"}
+        )
+        self.assertEqual(config.star_via, "other.example.com")
+        self.assertEqual(config.star_message_template, "{pill}: {body}")
+
+        # Templates using unknown fields are rejected
+        with self.assertRaises(ConfigError):
+            self._make_config({"message_template": "{room}: {body}"})
+
+        # As are malformed templates
+        with self.assertRaises(ConfigError):
+            self._make_config({"message_template": "{body"})
+
     def test_get_cfg(self):
         """Test that Config._get_cfg works correctly"""
 
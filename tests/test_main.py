@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+from unittest.mock import Mock, patch
+
+import nio
+
+from star_bot.main import _join_with_retry
+
+from tests.utils import run_coroutine
+
+
+class JoinWithRetryTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # run_coroutine closes the event loop after use, so give each test a fresh one
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+        self.fake_client = Mock(spec=nio.AsyncClient)
+
+        # How many joins should fail before one succeeds, and which rooms we tried
+        self.failed_joins = 0
+        self.join_attempts = []
+
+        async def fake_join(room_id):
+            self.join_attempts.append(room_id)
+            if len(self.join_attempts) <= self.failed_joins:
+                return nio.JoinError("Something went wrong")
+            return nio.JoinResponse(room_id)
+
+        self.fake_client.join = fake_join
+
+        # Record how long we back off for, without actually waiting
+        self.sleeps = []
+
+        async def fake_sleep(delay):
+            self.sleeps.append(delay)
+
+        sleep_patcher = patch("star_bot.main.asyncio.sleep", fake_sleep)
+        sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def test_join_succeeds_after_retrying(self):
+        """Tests that a failed join is retried with backoff until it succeeds"""
+        self.failed_joins = 2
+
+        joined = run_coroutine(_join_with_retry(self.fake_client, "!room:example.com"))
+
+        self.assertTrue(joined)
+        self.assertEqual(self.join_attempts, ["!room:example.com"] * 3)
+        self.assertEqual(self.sleeps, [0.5, 1])
+
+    def test_join_gives_up(self):
+        """Tests that we give up joining after the given number of attempts"""
+        self.failed_joins = 10
+
+        joined = run_coroutine(
+            _join_with_retry(self.fake_client, "!room:example.com", attempts=4)
+        )
+
+        self.assertFalse(joined)
+        self.assertEqual(len(self.join_attempts), 4)
+        # No need to wait after the final attempt
+        self.assertEqual(self.sleeps, [0.5, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()